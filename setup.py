@@ -34,8 +34,8 @@ setup(
     ],
     install_requires = [
         "discord.py>=2.0.0,<3.0.0",
-        "urllib3>=1.26.12,<3.0.0",
-        "iterable-io>=1.0.0,<2.0.0",
+        "urllib3>=2.0.0,<3.0.0",
+        "orjson>=3.0.0,<4.0.0",
     ],
     packages=["slack_to_discord"],
     entry_points={
@@ -1,9 +1,9 @@
 #!/usr/bin/env python
 
 import io
+import re
 from tempfile import SpooledTemporaryFile
 
-from iterableio import open_iterable
 import urllib3
 
 
@@ -16,6 +16,8 @@ DEFAULT_BUFFER_SIZE = 10 * 1024 * 1024  # 10M
 (only used if the remote server doesn't support range requests)
 """
 
+CONTENT_RANGE_RE = re.compile(r"bytes \d+-\d+/(\d+)")
+
 
 class SeekableHTTPStream(io.BufferedIOBase):
     """Make the contents at a URL addressable via a seekable file-like object.
@@ -24,35 +26,51 @@ class SeekableHTTPStream(io.BufferedIOBase):
 
     Notes:
      - The server must respond with an `Accept-Ranges: bytes` header for seeking to be supported.
-     - Using `__len__` or `io.SEEK_END` to seek requires the server to have sent a valid `Content-Length` header.
+     - Using `__len__` or `io.SEEK_END` to seek requires the server to have sent a valid `Content-Length` header
+       (or a `Content-Range` header in response to a range request).
+     - Pass in a shared `pool` (a `urllib3.PoolManager`) when opening multiple
+       streams so connections to the same host can be reused between them.
     """
 
-    def __init__(self, url, chunk_size=DEFAULT_CHUNK_SIZE):
+    def __init__(self, url, chunk_size=DEFAULT_CHUNK_SIZE, pool=None):
         self._pos = 0
         self._url = url
-        self._pool = urllib3.PoolManager()
+        self._pool = pool or urllib3.PoolManager()
         self._resp = None
         self._buff = None
 
         self._chunk_size = chunk_size
+        self._content_length = None
         self._do_request()
 
         try:
             self._content_length = int(self._resp.headers.get("Content-Length"))
         except TypeError:
-            self._content_length = None
+            pass
 
         self._seekable = self._resp.headers.get("Accept-Ranges", "").lower() == "bytes"
 
-    def _reset(self):
-        if self._resp:
+    def _reset(self, drain=False):
+        # `drain` is only used when making another request - closing shouldn't block on
+        # reading data (it can be called from an event loop).
+        resp = self._resp
+        if resp:
+            remaining = resp.length_remaining
+            if remaining:
+                # The connection can only be reused once the response has been fully read.
+                # Read off small remainders instead of throwing away the connection, but
+                # don't download lots of data just to reuse it.
+                if drain and remaining <= self._chunk_size * 2:
+                    resp.drain_conn()
+                else:
+                    resp.close()
             # release the connection back into the pool
-            self._resp.release_conn()
+            resp.release_conn()
         self._resp = None
         self._buff = None
 
     def _do_request(self, start=0):
-        self._reset()
+        self._reset(drain=True)
 
         headers = {}
         if start > 0:
@@ -73,12 +91,18 @@ class SeekableHTTPStream(io.BufferedIOBase):
                 "Bad status code: {}".format(resp.status)
             )
         else:
+            if resp.status == 206 and self._content_length is None:
+                # Partial responses include the total length of the content
+                m = CONTENT_RANGE_RE.match(resp.headers.get("Content-Range", ""))
+                if m:
+                    self._content_length = int(m.group(1))
+
             self._resp = resp
-            self._buff = open_iterable(
-                resp.stream(amt=self._chunk_size, decode_content=True),
-                mode="rb",
-                buffering=self._chunk_size
-            )
+            # The response is a raw IO object - buffer it directly without any adapters
+            # (requires urllib3 2.x where read(amt) returns at most `amt` decoded bytes)
+            # (auto_close would make the response look closed to the buffer at EOF)
+            resp.auto_close = False
+            self._buff = io.BufferedReader(resp, buffer_size=self._chunk_size)
 
     def __len__(self):
         if self._content_length is None:
@@ -105,12 +129,46 @@ class SeekableHTTPStream(io.BufferedIOBase):
         raise io.UnsupportedOperation()
 
     def read(self, size=-1):
-        if self._buff is None:
+        buff = self._buff
+        if buff is None:
+            return b""
+        data = buff.read(size)
+        self._pos += len(data)
+        return data
+
+    def readinto(self, b):
+        # Read directly into the provided buffer instead of going through read()
+        buff = self._buff
+        if buff is None:
+            return 0
+        num = buff.readinto(b)
+        self._pos += num
+        return num
+
+    def read1(self, size=-1):
+        # Return whatever is available with at most one read from the response
+        buff = self._buff
+        if buff is None:
             return b""
-        data = self._buff.read(size)
+        data = buff.read1(size)
         self._pos += len(data)
         return data
 
+    def peek(self, size=0):
+        # Return buffered data without advancing the position (may return more or less than `size`)
+        buff = self._buff
+        if buff is None:
+            return b""
+        return buff.peek(size)
+
+    def readinto1(self, b):
+        buff = self._buff
+        if buff is None:
+            return 0
+        num = buff.readinto1(b)
+        self._pos += num
+        return num
+
     def _calc_new_pos(self, offset, whence):
         if whence == io.SEEK_SET:
             new_pos = offset
@@ -123,22 +181,24 @@ class SeekableHTTPStream(io.BufferedIOBase):
         else:
             raise ValueError("Invalid whence: {}".format(whence))
 
-        if self._content_length is not None:
-            new_pos = min(new_pos, self._content_length)
-
-        return max(0, new_pos)
+        # clamp to [0, content length]
+        content_length = self._content_length
+        if content_length is not None and new_pos > content_length:
+            return content_length
+        return new_pos if new_pos > 0 else 0
 
     def seek(self, offset, whence=io.SEEK_SET):
         if not self.seekable():
             raise io.UnsupportedOperation(f"URL '{self._url}' does not support range requests")
 
         new_pos = self._calc_new_pos(offset, whence)
+        pos = self._pos
         if new_pos == self._content_length:
             # seeking to end - no more data
             self._reset()
-        elif new_pos != self._pos:
+        elif new_pos != pos:
             # Figure out how far off we are and how to deal with it
-            pos_diff = new_pos - self._pos
+            pos_diff = new_pos - pos
 
             if 0 < pos_diff < self._chunk_size * 2:
                 # seeking forwards and we're close enough (within 2 iterations of
@@ -191,21 +251,82 @@ class CachedSeekableHTTPStream(SeekableHTTPStream):
         if self._cache is None:
             return super().read(size)
 
-        buff = bytearray()
+        data = b""
 
         buffered = min(size, self._cache_size - self.tell())
         if buffered:
             # get data from the buffer
-            buff += self._cache.read(buffered)
+            data = self._cache.read(buffered)
             if buffered > 0:
                 size -= buffered
         if size:
             # get more data from the stream
             new = super().read(size)
-            buff += new
             self._cache_size += self._cache.write(new)
+            # avoid copying when all the data came from one place
+            data = data + new if data else new
+
+        return data
+
+    def readinto(self, b):
+        if self._cache is None:
+            return super().readinto(b)
+
+        view = memoryview(b).cast("B")
+        size = len(view)
+        num = 0
+
+        buffered = min(size, self._cache_size - self.tell())
+        if buffered > 0:
+            # get data from the cache
+            data = self._cache.read(buffered)
+            num = len(data)
+            view[:num] = data
+        if num < size:
+            # read more data from the stream directly into the buffer, then cache it from there
+            new = super().readinto(view[num:])
+            self._cache_size += self._cache.write(view[num:num + new])
+            num += new
+
+        return num
+
+    def read1(self, size=-1):
+        if self._cache is None:
+            return super().read1(size)
+
+        buffered = self._cache_size - self.tell()
+        if buffered:
+            # return what's already in the cache
+            return self._cache.read(buffered if size < 0 else min(size, buffered))
+
+        new = super().read1(size)
+        self._cache_size += self._cache.write(new)
+        return new
 
-        return bytes(buff)
+    def readinto1(self, b):
+        if self._cache is None:
+            return super().readinto1(b)
+
+        # Copy through a byte view so the plain memcpy path is used for any buffer type
+        view = memoryview(b).cast("B")
+        data = self.read1(len(view))
+        num = len(data)
+        view[:num] = data
+        return num
+
+    def peek(self, size=0):
+        if self._cache is None:
+            return super().peek(size)
+
+        pos = self.tell()
+        buffered = self._cache_size - pos
+        if buffered <= 0:
+            # at the end of the cache - the stream is at the same position
+            return super().peek(size)
+
+        data = self._cache.read(min(max(size, 1), buffered))
+        self._cache.seek(pos)
+        return data
 
     def seek(self, offset, whence=io.SEEK_SET):
         if self._cache is None:
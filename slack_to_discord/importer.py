@@ -1,21 +1,33 @@
 #!/usr/bin/env python
 
+import asyncio
+import collections
+import concurrent.futures
 import contextlib
+import fnmatch
 import functools
-import glob
 import html
+import itertools
 import json
 import logging
-import os
+import operator
+import posixpath
 import re
-import tempfile
 import textwrap
+import time
 from zipfile import ZipFile
 from datetime import datetime
 from urllib.parse import urlparse
 
 import discord
 from discord.errors import Forbidden
+import urllib3
+
+# orjson is much faster at parsing large exports, fall back to the stdlib if it's not available
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 from slack_to_discord.http_stream import CachedSeekableHTTPStream
 from slack_to_discord.emojis import GLOBAL_EMOJI_MAP
@@ -25,6 +37,20 @@ from slack_to_discord.emojis import GLOBAL_EMOJI_MAP
 MAX_MESSAGE_SIZE = 2000
 MAX_THREADNAME_SIZE = 100
 
+# Discord rate limits (max messages, per number of seconds) for webhooks posting to a channel/thread
+WEBHOOK_RATE_LIMIT = (30, 60)
+
+# How many channels to import at the same time
+CONCURRENT_CHANNELS = 4
+
+# How many messages ahead of the one being sent to start downloading attachments for
+PREFETCH_MESSAGES = 2
+# The max number of attachments to have open ahead of time (per channel)
+PREFETCH_FILES = 2
+
+# Timeouts for requests to download attachments from Slack
+HTTP_TIMEOUT = urllib3.Timeout(connect=10, read=60)
+
 # Date and time formats
 DATE_FORMAT = "%Y-%m-%d"
 TIME_FORMAT = "%H:%M"
@@ -38,46 +64,149 @@ ATTACHMENT_ERROR_APPEND = "\n<original file not uploaded due to size restriction
 # Create a separator between dates? (None for no)
 DATE_SEPARATOR = "`{:-^30}`"
 
-MENTION_RE = re.compile(r"<([@!#])([^>]*?)(?:\|([^>]*?))?>")
-LINK_RE = re.compile(r"<((?:https?|mailto|tel):[A-Za-z0-9_\+\.\-\/\?\,\=\#\:\@\(\)]+)\|([^>]+)>")
 EMOJI_RE = re.compile(r":([^ /<>:]+):(?::skin-tone-(\d):)?")
 
+# Matches mentions (<@USERID>, <#CHANID|name>, etc), links (<https://url|text>),
+# and emojis (:name:, :name::skin-tone-N:) so messages only need to be scanned once
+MARKUP_RE = re.compile(
+    r"<(?:"
+    r"(?P<type>[@!#])(?P<target>[^>]*?)(?:\|(?P<name>[^>]*?))?"
+    r"|"
+    r"(?P<url>(?:https?|mailto|tel):[A-Za-z0-9_\+\.\-\/\?\,\=\#\:\@\(\)]+)\|[^>]+"
+    r")>"
+    r"|"
+    r":(?P<emoji>[^ /<>:]+):(?::skin-tone-(?P<tone>\d):)?"
+)
+THUMB_RE = re.compile(r"thumb_(\d+)")
+
 
 
 __log__ = logging.getLogger(__name__)
 
 
-def emoji_replace(s, emoji_map):
-    def replace(match):
-        e, t = match.groups()
+def resolve_emoji(e, t, emoji_map):
+    # Convert -'s to "_"s except the 1st char (ex. :-1:)
+    # On Slack some emojis use underscores and some use dashes
+    # On Discord everything uses underscores
+    if len(e) > 1 and "-" in e[1:]:
+        e = e[0] + e[1:].replace("-", "_")
 
-        # Convert -'s to "_"s except the 1st char (ex. :-1:)
-        # On Slack some emojis use underscores and some use dashes
-        # On Discord everything uses underscores
-        if len(e) > 1 and "-" in e[1:]:
-            e = e[0] + e[1:].replace("-", "_")
+    # Note that custom emojis in the emoji_map are in the format
+    # "<a:emoji_name:numeric_id>". Returning ":emoji_name:" doesn't work
+    # (it just renders the literal text).
+    if e in emoji_map:
+        return emoji_map[e]
 
-        # Note that custom emojis in the emoji_map are in the format
-        # "<a:emoji_name:numeric_id>". Returning ":emoji_name:" doesn't work
-        # (it just renders the literal text).
-        if e in emoji_map:
-            return emoji_map[e]
+    if e in GLOBAL_EMOJI_MAP:
+        e = GLOBAL_EMOJI_MAP[e]
 
-        if e in GLOBAL_EMOJI_MAP:
-            e = GLOBAL_EMOJI_MAP[e]
+    # Convert Slack's skin tone system to Discord's
+    if t is not None:
+        return ":{}_tone{}:".format(e, int(t)-1)
+    else:
+        return ":{}:".format(e)
 
-        # Convert Slack's skin tone system to Discord's
-        if t is not None:
-            return ":{}_tone{}:".format(e, int(t)-1)
-        else:
-            return ":{}:".format(e)
 
-    return EMOJI_RE.sub(replace, s)
+class EmojiReplacer:
+    """Replaces Slack emojis in text with their Discord equivalents
+
+    The same handful of emojis tend to be used over and over so the resolved
+    replacement for each (emoji, skin tone) pair is cached.
+    """
+
+    def __init__(self, emoji_map):
+        self._emoji_map = emoji_map
+
+        # Pre-resolve the custom and remapped emojis (without skin tones) up front
+        self._cache = {
+            (e, None): resolve_emoji(e, None, emoji_map)
+            for e in itertools.chain(GLOBAL_EMOJI_MAP, emoji_map)
+        }
+
+    def resolve(self, e, t):
+        key = (e, t)
+        try:
+            return self._cache[key]
+        except KeyError:
+            r = self._cache[key] = resolve_emoji(e, t, self._emoji_map)
+            return r
+
+    def _replace(self, match):
+        return self.resolve(*match.groups())
+
+    def __call__(self, s):
+        return EMOJI_RE.sub(self._replace, s)
+
+
+class SlackExport:
+    """Provides access to the data in a Slack export zip file
+
+    Files are read directly out of the zip file as they're needed instead of
+    extracting everything to disk first.
+    """
+
+    def __init__(self, zipfile):
+        self._zip = ZipFile(zipfile, "r")
+
+        # Non-ASCII filenames in the zip seem to be encoded using UTF-8, but don't set the flag
+        # that signals this. This means Python will use cp437 to decode them, resulting in
+        # mangled filenames. Fix this by undoing the cp437 decode and using UTF-8 instead
+        self._files = {}
+        self._channel_files = collections.defaultdict(list)
+        for zipinfo in self._zip.infolist():
+            if not zipinfo.flag_bits & (1 << 11):
+                # UTF-8 flag not set, cp437 was used to decode the filename
+                with contextlib.suppress(UnicodeEncodeError, UnicodeDecodeError):
+                    zipinfo.filename = zipinfo.filename.encode("cp437").decode("utf-8")
+            self._files[zipinfo.filename] = zipinfo
+
+            # Index the message files by channel ("<channel name>/YYYY-MM-DD.json")
+            dirname, filename = posixpath.split(zipinfo.filename)
+            if dirname and fnmatch.fnmatch(filename, "*-*-*.json"):
+                self._channel_files[dirname].append(zipinfo.filename)
+
+        for files in self._channel_files.values():
+            files.sort()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def close(self):
+        self._zip.close()
+
+    def open_json(self, path):
+        try:
+            zipinfo = self._files[path]
+        except KeyError:
+            raise FileNotFoundError("'{}' not found in the export".format(path)) from None
+
+        data = self._zip.read(zipinfo)
+        if orjson is not None:
+            try:
+                return orjson.loads(data)
+            except orjson.JSONDecodeError:
+                # orjson is stricter than the stdlib (lone surrogates, BOMs, huge floats, etc)
+                __log__.debug("Failed to parse '%s' with orjson - retrying with json", path, exc_info=True)
+        return json.loads(data)
+
+    def channel_files(self, channel_name):
+        # Sorted list of the channel's day files (don't modify it)
+        return self._channel_files.get(channel_name, [])
+
+
+def make_userinfo(name, avatar=None):
+    # (name, avatar URL, name escaped for use in Markdown)
+    return (name, avatar, name.replace("_", "\\_"))
+
 
+UNKNOWN_USER = make_userinfo("[unknown]")
 
-def slack_usermap(d, real_names=False):
-    with open(os.path.join(d, "users.json"), "rb") as fp:
-        data = json.load(fp)
+
+def slack_usermap(export, real_names=False):
+    data = export.open_json("users.json")
 
     def get_userinfo(userdata):
         profile = userdata["profile"]
@@ -86,24 +215,23 @@ def slack_usermap(d, real_names=False):
         else:
             # bots sometimes don't set a display name - fall back to the internal username
             name = profile["display_name_normalized"] or userdata["name"]
-        return (name, profile.get("image_original"))
+        return make_userinfo(name, profile.get("image_original"))
 
 
     r = {x["id"]: get_userinfo(x) for x in data}
-    r["USLACKBOT"] = ("Slackbot", None)
-    r["B01"] = ("Slackbot", None)
+    r["USLACKBOT"] = make_userinfo("Slackbot")
+    r["B01"] = make_userinfo("Slackbot")
     return r
 
 
-def slack_channels(d):
+def slack_channels(export):
     topic = lambda x: "\n\n".join([x[k]["value"] for k in ("purpose", "topic") if x[k]["value"]])
     pins = lambda x: set(p["id"] for p in x.get("pins", []))
 
     for is_private, file in ((False, "channels.json"), (True, "groups.json")):
         with contextlib.suppress(FileNotFoundError):
-            with open(os.path.join(d, file), "rb") as fp:
-                for x in json.load(fp):
-                    yield x["name"], topic(x), pins(x), is_private
+            for x in export.open_json(file):
+                yield x["name"], topic(x), pins(x), is_private
 
 
 def slack_filedata(f):
@@ -124,10 +252,10 @@ def slack_filedata(f):
 
     # Make a list of thumbnails for this file in case the original can't be posted
     thumbs = [
-        f[t]
-        for t in sorted(
-            (k for k in f if re.fullmatch("thumb_(\\d+)", k)),
-            key=lambda x: int(x.split("_")[-1]),
+        f[k]
+        for k in sorted(
+            (k for k in f if THUMB_RE.fullmatch(k)),
+            key=lambda k: int(k[6:]),
             reverse=True
         )
     ]
@@ -142,62 +270,135 @@ def slack_filedata(f):
     }
 
 
-def slack_channel_messages(datadir, channel_name, users, emoji_map, pins):
-    def mention_repl(m):
-        type_ = m.group(1)
-        target = m.group(2)
-        channel_name = m.group(3)
-
-        if type_ == "#":
-            return "`#{}`".format(channel_name)
-        elif channel_name is not None:
-            return m.group(0)
+@functools.lru_cache(maxsize=None)
+def format_date(d):
+    # Lots of messages are sent on the same day - avoid reformatting the same date over and over
+    return d.strftime(DATE_FORMAT)
+
+
+@functools.lru_cache(maxsize=None)
+def format_time(t):
+    # Same idea as format_date - at most 86400 unique values (the microseconds are dropped)
+    return t.strftime(TIME_FORMAT)
+
+
+def slack_unescape(text):
+    # Slack only escapes "&", "<", and ">" so handle them with plain replaces. Anything
+    # else that could be an entity is rare enough to leave to html.unescape.
+    lt, gt, amp = text.count("&lt;"), text.count("&gt;"), text.count("&amp;")
+    if lt + gt + amp != text.count("&"):
+        return html.unescape(text)
+    if lt:
+        text = text.replace("&lt;", "<")
+    if gt:
+        text = text.replace("&gt;", ">")
+    if amp:
+        # done last so "&amp;lt;" correctly becomes "&lt;"
+        text = text.replace("&amp;", "&")
+    return text
+
+
+class Message:
+    # There can be a lot of these so use __slots__ instead of a dict per message
+    __slots__ = ("userinfo", "datetime", "time", "date", "text", "replies", "reactions", "files", "events")
+
+    def __init__(self, *, userinfo, datetime, time, date, text, replies, reactions, files, events):
+        self.userinfo = userinfo
+        self.datetime = datetime
+        self.time = time
+        self.date = date
+        self.text = text
+        self.replies = replies
+        self.reactions = reactions
+        self.files = files
+        self.events = events
+
+    def __repr__(self):
+        return "{}({})".format(
+            self.__class__.__name__,
+            ", ".join("{}={!r}".format(k, getattr(self, k)) for k in self.__slots__)
+        )
 
-        if type_ == "@":
-            return "`@{}`".format(users[target][0] if target in users else "[unknown]")
-        elif type_ == "!":
-            return "`@{}`".format(target)
+    def __getitem__(self, key):
+        # Allows using the message with str.format_map
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+
+
+def markup_repl(users_get, emoji_replace, m):
+    # Defined once at module level and bound to the user map per channel with functools.partial
+    type_, target, channel_name, url, emoji = m.group("type", "target", "name", "url", "emoji")
+    if emoji is not None:
+        return emoji_replace.resolve(emoji, m.group("tone"))
+    elif url is not None:
+        return url
+
+    if type_ == "#":
+        return "`#{}`".format(channel_name)
+    elif channel_name is not None:
         return m.group(0)
 
+    if type_ == "@":
+        return "`@" + users_get(target, UNKNOWN_USER)[0] + "`"
+    elif type_ == "!":
+        return "`@" + target + "`"
+    return m.group(0)
+
+
+def slack_channel_messages(export, channel_name, users, emoji_replace, pins):
+    # bots discovered below are added to `users` in-place so the bound lookup sees them
+    repl = functools.partial(markup_repl, users.get, emoji_replace)
+
+    reaction_cache = {}
+    def reaction_emoji(name):
+        try:
+            return reaction_cache[name]
+        except KeyError:
+            r = reaction_cache[name] = emoji_replace(":{}:".format(name))
+            return r
+
     def getkey(f, d, k):
         try:
             return d[k]
         except KeyError:
-            relpath = os.path.relpath(f, start=datadir)
             __log__.critical(
                 "The following message from file '%s' does not contain key '%s':\n%r",
-                relpath, k, d
+                f, k, d
             )
             raise
 
-    channel_dir = os.path.join(datadir, channel_name)
-    if not os.path.isdir(channel_dir):
+    day_files = export.channel_files(channel_name)
+    if not day_files:
         __log__.error("Data for channel '#%s' not found in export", channel_name)
 
     messages = {}
+    reply_pos = {}  # (thread_ts, ts) -> (replies, index) to replace duplicate replies like messages are
     file_ts_map = {}
-    for file in sorted(glob.glob(os.path.join(channel_dir, "*-*-*.json"))):
-        with open(file, "rb") as fp:
-            data = json.load(fp)
-        for d in sorted(data, key=lambda x: getkey(file, x, "ts")):
+    for file in day_files:
+        # Convert the timestamps once - they're used for sorting and creating the datetimes
+        data = [(float(getkey(file, d, "ts")), d) for d in export.open_json(file)]
+        data.sort(key=operator.itemgetter(0))
+        for ts_f, d in data:
             text = getkey(file, d, "text")
-            text = MENTION_RE.sub(mention_repl, text)
-            text = LINK_RE.sub(lambda x: x.group(1), text)
-            text = emoji_replace(text, emoji_map)
-            text = html.unescape(text)
+            if "<" in text or ":" in text:
+                text = MARKUP_RE.sub(repl, text)
+            if "&" in text:
+                text = slack_unescape(text)
             text = text.rstrip()
 
             ts = d["ts"]
 
             user_id = d.get("user")
             subtype = d.get("subtype", "")
-            files = d.get("files", [])
+            files = d.get("files") or ()
             thread_ts = d.get("thread_ts", ts)
             events = {}
 
             # add bots to user map as they're discovered
             if subtype.startswith("bot_") and "bot_id" in d and d["bot_id"] not in users:
-                users[d["bot_id"]] = (d.get("username", "[unknown bot]"), None)
+                users[d["bot_id"]] = make_userinfo(d.get("username", "[unknown bot]"))
                 user_id = d["bot_id"]
 
             # Treat file comments as threads started on the message that posted the file
@@ -237,31 +438,32 @@ def slack_channel_messages(datadir, channel_name, users, emoji_map, pins):
             if ts in pins:
                 events["pin"] = True
 
-            # Store a map of fileid to ts so file comments can be treated as replies
+            filedata = []
             for f in files:
+                # Store a map of fileid to ts so file comments can be treated as replies
                 file_ts_map[f["id"]] = ts
 
-            # Ignore tombstoned (removed) files and ones that don't have a URL
-            files = [x for x in files if x.get("mode") != "tombstone" and x.get("url_private")]
-
-            dt = datetime.fromtimestamp(float(ts))
-            msg = {
-                "userinfo": users.get(user_id, ("[unknown]", None)),
-                "datetime": dt,
-                "time": dt.strftime(TIME_FORMAT),
-                "date": dt.strftime(DATE_FORMAT),
-                "text": text,
-                "replies": {},
-                "reactions": {
-                    emoji_replace(":{}:".format(x["name"]), emoji_map): [
-                        users[u][0].replace("_", "\\_") if u in users else "[unknown]"
-                        for u in x["users"]
+                # Ignore tombstoned (removed) files and ones that don't have a URL
+                if f.get("mode") != "tombstone" and f.get("url_private"):
+                    filedata.append(slack_filedata(f))
+
+            dt = datetime.fromtimestamp(ts_f)
+            msg = Message(
+                userinfo=users.get(user_id, UNKNOWN_USER),
+                datetime=dt,
+                time=format_time(dt.time().replace(microsecond=0)),
+                date=format_date(dt.date()),
+                text=text,
+                replies=[],
+                reactions={
+                    reaction_emoji(x["name"]): [
+                        users.get(u, UNKNOWN_USER)[2] for u in x["users"]
                     ]
                     for x in d.get("reactions", [])
                 },
-                "files": [slack_filedata(f) for f in files],
-                "events": events
-            }
+                files=filedata,
+                events=events
+            )
 
             # If this is a reply, add it to the parent message's replies
             # Replies have a "thread_ts" that differs from their "ts"
@@ -270,14 +472,24 @@ def slack_channel_messages(datadir, channel_name, users, emoji_map, pins):
                     # Orphan thread message - skip it
                     __log__.debug("Orphan threaded message - skipping it:\n%r", msg)
                     continue
-                messages[thread_ts]["replies"][ts] = msg
+                replies = messages[thread_ts].replies
+                prev_replies, idx = reply_pos.get((thread_ts, ts), (None, None))
+                if prev_replies is replies:
+                    # Duplicate reply - keep the latest version in the original spot
+                    replies[idx] = msg
+                else:
+                    # New reply (or the parent was replaced and its replies are starting over)
+                    reply_pos[thread_ts, ts] = (replies, len(replies))
+                    replies.append(msg)
             else:
                 messages[ts] = msg
 
-    # Sort the dicts by timestamp and yield the messages
-    for msg in (messages[x] for x in sorted(messages.keys())):
-        msg["replies"] = [msg["replies"][x] for x in sorted(msg["replies"].keys())]
-        yield msg
+        # Release the file's data before the next one is loaded
+        del data
+
+    # The files and the messages in them were processed in timestamp order so the
+    # messages dict and reply lists are already sorted (dicts preserve insertion order)
+    yield from messages.values()
 
 
 def mark_end(iterable):
@@ -297,35 +509,43 @@ def mark_end(iterable):
         yield True, a
 
 
+@functools.lru_cache(maxsize=None)
+def message_wrapper(width):
+    # Wrappers are reused since creating them is relatively expensive
+    # (the width only varies with the length of the message prefix)
+    return textwrap.TextWrapper(width=width, drop_whitespace=False, replace_whitespace=False)
+
+
+THREAD_NAME_WRAPPER = textwrap.TextWrapper(width=MAX_THREADNAME_SIZE, max_lines=1, placeholder="…")
+
+
 def make_discord_msgs(msg):
 
     # Show reactions listed in an embed
     embed = None
-    if msg["reactions"]:
+    reactions = msg.reactions
+    if reactions:
         embed = discord.Embed(
-            description="\n".join(
-                "{} {}".format(k, ", ".join(v)) for k, v in msg["reactions"].items()
-            )
+            description="\n".join([k + " " + ", ".join(v) for k, v in reactions.items()])
         )
 
     # Split the text into chunks to keep it under MAX_MESSAGE_SIZE
     # Send everything except the last chunk
+    # Only format the message template once - split it around the text so
+    # each chunk can just be concatenated with it
     content = None
-    prefix_len = len(MSG_FORMAT.format(**{**msg, "text": ""}))
-    for is_last, chunk in mark_end(textwrap.wrap(
-        text=msg.get("text") or "",
-        width=MAX_MESSAGE_SIZE - prefix_len,
-        drop_whitespace=False,
-        replace_whitespace=False
-    )):
-        content = MSG_FORMAT.format(**{**msg, "text": chunk.strip()})
+    prefix, _, suffix = MSG_FORMAT.format_map(collections.ChainMap({"text": "\0"}, msg)).partition("\0")
+    for is_last, chunk in mark_end(
+        message_wrapper(MAX_MESSAGE_SIZE - len(prefix) - len(suffix)).wrap(msg.text or "")
+    ):
+        content = prefix + chunk.strip() + suffix
         if not is_last:
             yield {
                 "content": content
             }
 
     # Send the original message without any files
-    if len(msg["files"]) == 1:
+    if len(msg.files) == 1:
         # if there is a single file attached, put reactions on the the file
         if content:
             yield {
@@ -340,18 +560,38 @@ def make_discord_msgs(msg):
         embed = None
 
     # Send one messge per image that was posted (using the picture title as the message)
-    for f in msg["files"]:
+    for f in msg.files:
         yield {
-            "content": MSG_FORMAT.format(**{**msg, "text": ATTACHMENT_TITLE_TEXT.format(**f)}),
+            "content": prefix + ATTACHMENT_TITLE_TEXT.format_map(f) + suffix,
             "file_data": f,
             "embed": embed
         }
         embed = None
 
 
-def file_upload_attempts(data):
+async def open_stream(url, pool=None, executor=None):
+    # Opening the stream makes the initial HTTP request - do it in a thread to avoid blocking
+    # (use a dedicated `executor` so slow requests can't tie up the loop's default one)
+    return await asyncio.get_running_loop().run_in_executor(
+        executor,
+        functools.partial(CachedSeekableHTTPStream, url, pool=pool)
+    )
+
+
+def close_stream(task):
+    # Close a stream that was opened but never used (as soon as it finishes opening)
+    def close(t):
+        if not t.cancelled() and t.exception() is None:
+            t.result().close()
+
+    task.add_done_callback(close)
+
+
+async def file_upload_attempts(data, streams=None, pool=None, executor=None, size_limit=None):
     # Files that are too big cause issues
     # yield data to try to send (original, then thumbnails)
+    # `streams` can map URLs to tasks that are already opening them (see FilePrefetcher)
+    # Files larger than `size_limit` are skipped without trying to upload them
     fd = data.pop("file_data", None)
     if not fd:
         yield data
@@ -365,21 +605,29 @@ def file_upload_attempts(data):
             filename = fd["name"]
 
         try:
-            f = discord.File(
-                fp=CachedSeekableHTTPStream(url),
-                filename=filename
-            )
+            task = streams.pop(url, None) if streams else None
+            stream = await (task or open_stream(url, pool=pool, executor=executor))
         except Exception:
             __log__.debug("Failed to upload file", exc_info=True)
         else:
-            yield {
-                **data,
-                "file": f
-            }
+            try:
+                too_big = size_limit is not None and len(stream) > size_limit
+            except TypeError:
+                too_big = False  # unknown length - just try it
+
+            if too_big:
+                # Discord would reject it anyway - don't bother downloading it
+                __log__.debug("File at '%s' is over the size limit - skipping it", url)
+                stream.close()
+            else:
+                yield {
+                    **data,
+                    "file": discord.File(fp=stream, filename=filename)
+                }
 
         # The original URL failed - trying thumbnails
         if i < 1:
-            data["content"] += ATTACHMENT_ERROR_APPEND.format(**fd)
+            data["content"] += ATTACHMENT_ERROR_APPEND.format_map(fd)
 
     __log__.error("Failed to upload file for message '%s'", data["content"])
 
@@ -387,18 +635,130 @@ def file_upload_attempts(data):
     yield data
 
 
+def close_upload(data):
+    # discord.File doesn't close file objects that are passed to it. Close the
+    # stream as soon as it's been used so its connection and any cached data
+    # are released instead of piling up until they're garbage collected.
+    f = data.get("file")
+    if f is not None:
+        f.close()  # restores the stream's close method (discord.File stubs it out)
+        f.fp.close()
+
+
+class FilePrefetcher:
+    """Opens the files attached to upcoming messages ahead of time
+
+    `msgs` are all the messages that will be sent (including replies) in the order they'll be
+    sent. Each open file holds a connection that sits idle until the file is uploaded so only
+    files for the next few messages are opened, and only a few at a time.
+    """
+
+    def __init__(self, msgs, open_func, max_open=PREFETCH_FILES, max_ahead=PREFETCH_MESSAGES):
+        self._open_func = open_func
+        self._max_open = max_open
+        self._max_ahead = max_ahead
+
+        self._index = {id(m): i for i, m in enumerate(msgs)}
+        self._files = [(i, f["url"]) for i, m in enumerate(msgs) for f in m.files]
+        self._next = 0  # index into self._files of the next file to open
+        self._current = 0  # index of the message being sent
+        self._open = collections.deque()  # (message index, url, task) in send order
+
+    def sending(self, msg):
+        # Called before `msg` is sent
+        self._current = self._index[id(msg)]
+
+        # Files for earlier messages won't be used (ex: replies to a thread that couldn't be created)
+        while self._open and self._open[0][0] < self._current:
+            close_stream(self._open.popleft()[2])
+        while self._next < len(self._files) and self._files[self._next][0] < self._current:
+            self._next += 1
+
+        self._fill()
+
+    def pop(self, url, default=None):
+        # Take the task opening `url` if it was opened ahead of time
+        for i, (_, u, task) in enumerate(self._open):
+            if u == url:
+                del self._open[i]
+                self._fill()
+                return task
+
+        # Not opened yet - make sure it won't be opened later
+        if self._next < len(self._files) and self._files[self._next] == (self._current, url):
+            self._next += 1
+        return default
+
+    def _fill(self):
+        limit = self._current + self._max_ahead
+        while len(self._open) < self._max_open and self._next < len(self._files):
+            idx, url = self._files[self._next]
+            if idx > limit:
+                break
+            self._open.append((idx, url, asyncio.ensure_future(self._open_func(url))))
+            self._next += 1
+
+    def close(self):
+        while self._open:
+            close_stream(self._open.popleft()[2])
+
+
+class RateLimiter:
+    """Limits how many times something can happen within a sliding window of time
+
+    Used to pace messages so they stay under Discord's rate limits instead of
+    continually hitting them and being told to back off.
+    """
+
+    def __init__(self, limit, period):
+        self._limit = limit
+        self._period = period
+        self._times = collections.deque()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            while self._times and self._times[0] <= now - self._period:
+                self._times.popleft()
+
+            if len(self._times) < self._limit:
+                self._times.append(now)
+                return
+
+            await asyncio.sleep(self._times[0] + self._period - now)
+
+
+def rate_limited(send):
+    # Wrap a send function so it waits for the rate limit before sending
+    limiter = RateLimiter(*WEBHOOK_RATE_LIMIT)
+
+    async def _send(*args, **kwargs):
+        await limiter.acquire()
+        return await send(*args, **kwargs)
+
+    return _send
+
+
 class SlackImportClient(discord.Client):
 
-    def __init__(self, *args, data_dir, guild_name, channels, start, end, all_private, real_names, **kwargs):
-        self._data_dir = data_dir
+    def __init__(self, *args, export, guild_name, channels, start, end, all_private, real_names, **kwargs):
+        self._export = export
         self._guild_name = guild_name
         self._channels = channels or None
         self._all_private = all_private
         self._start, self._end = [datetime.strptime(x, DATE_FORMAT).date() if x else None for x in (start, end)]
 
-        self._users = slack_usermap(data_dir, real_names=real_names)
+        self._users = slack_usermap(export, real_names=real_names)
+
+        # Shared between all file downloads so connections to Slack are reused
+        # Each channel being imported has at most PREFETCH_FILES streams open ahead of time plus
+        # the one being uploaded. Size the pool and the threads that open them to match.
+        max_streams = CONCURRENT_CHANNELS * (PREFETCH_FILES + 1)
+        self._http_pool = urllib3.PoolManager(num_pools=4, maxsize=max_streams, timeout=HTTP_TIMEOUT)
+        self._http_executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_streams)
 
-        self._prev_msg = None
+        self._existing_channels = {}
+        self._filesize_limit = None
         self._exception = None
 
         super().__init__(
@@ -427,156 +787,217 @@ class SlackImportClient(discord.Client):
             __log__.debug("Stopped import due to a BaseException", exc_info=True)
             raise
         finally:
+            self._http_executor.shutdown(wait=False)
+            self._http_pool.clear()
             __log__.info("Bot logging out")
             await self.close()
 
-    async def _handle_date_sep(self, target, msg):
-        if DATE_SEPARATOR:
-            msg_date = msg["date"]
-            if (
-                not self._prev_msg or
-                self._prev_msg["date"] != msg_date
-            ):
-                await target.send(content=DATE_SEPARATOR.format(msg_date))
-            self._prev_msg = msg
+    async def _handle_date_sep(self, target, msg, prev_msg):
+        # Post a separator if the message was sent on a different date than the previous one
+        if DATE_SEPARATOR and (not prev_msg or prev_msg.date != msg.date):
+            await target.send(content=DATE_SEPARATOR.format(msg.date))
 
-    async def _send_slack_msg(self, send, msg):
+    async def _send_slack_msg(self, send, msg, streams=None):
         sent = None
-        pin = msg["events"].pop("pin", False)
+        pin = msg.events.pop("pin", False)
+
+        if streams is not None:
+            streams.sending(msg)
+
         for data in make_discord_msgs(msg):
-            for attempt in file_upload_attempts(data):
-                with contextlib.suppress(Exception):
-                    sent = await send(
-                        username=msg["userinfo"][0],
-                        avatar_url=msg["userinfo"][1],
-                        **attempt
-                    )
-                    if pin:
-                        pin = False
-                        # Requires the "manage messages" optional permission
-                        with contextlib.suppress(Forbidden):
-                            await sent.pin()
-                    break
+            async for attempt in file_upload_attempts(
+                data, streams, pool=self._http_pool, executor=self._http_executor,
+                size_limit=self._filesize_limit
+            ):
+                try:
+                    with contextlib.suppress(Exception):
+                        sent = await send(
+                            username=msg.userinfo[0],
+                            avatar_url=msg.userinfo[1],
+                            **attempt
+                        )
+                        if pin:
+                            pin = False
+                            # Requires the "manage messages" optional permission
+                            with contextlib.suppress(Forbidden):
+                                await sent.pin()
+                        break
+                finally:
+                    close_upload(attempt)
             else:
                 __log__.error("Failed to post message: '%s'", data["content"])
 
         return sent
 
-    async def _run_import(self, g):
-        emoji_map = {x.name: str(x) for x in self.emojis}
+    async def _send_thread(self, webhook, sent, msg, streams):
+        # Create a thread from the sent message and send the replies to it
+        thread_name = (
+            THREAD_NAME_WRAPPER.wrap(msg.text or "") or
+            [BACKUP_THREAD_NAME.format_map(msg).replace(":", "-")]  # ':' is not allowed in thread names
+        )[0]
+        thread = await sent.create_thread(name=thread_name)
+        try:
+            thread_send = rate_limited(functools.partial(webhook.send, wait=True, thread=thread))
+            # the first date separator in the thread is based on the message that started it
+            prev_reply = msg
+            for rmsg in msg.replies:
+                await self._handle_date_sep(thread, rmsg, prev_reply)
+                prev_reply = rmsg
+                await self._send_slack_msg(thread_send, rmsg, streams)
+        finally:
+            await thread.edit(archived=True)
+
+    def _messages_in_range(self, messages):
+        # skip messages that are too early, stop when messages are too late
+        for msg in messages:
+            if self._end and msg.datetime.date() > self._end:
+                break
+            elif self._start and  msg.datetime.date() < self._start:
+                continue
+            yield msg
+
+    async def _import_channel(self, g, chan, emoji_replace, parse_pool, prev_ready, ready):
+        # Import a single channel, returning (if the channel was used, number of messages sent)
+        # Channels are created in the order they're listed in the export. To keep that order when
+        # importing multiple channels at once, the channel isn't created until the previous one is
+        # `prev_ready` and `ready` is set once this one is (or it's determined it's not needed).
+        chan_name, init_topic, pins, is_private = chan
+        ch = None
+        ch_webhook, ch_send = None, None
+        prev_msg = None  # always start with the date in a new channel
+        c_msg = 0
 
-        __log__.info("Starting to import messages")
-        c_chan, c_msg, start_time = 0, 0, datetime.now()
+        try:
+            init_topic = emoji_replace(init_topic)
 
-        existing_channels = {x.name: x for x in g.text_channels}
+            __log__.info("Processing channel '#%s'...", chan_name)
 
-        for webhook in await g.webhooks():
-            if webhook.user == self.user and webhook.name == "s2d-importer":
-                __log__.info("Cleaning up previous webhook %s", webhook)
-                await webhook.delete()
+            # Parse in a background thread so it doesn't block the event loop (and the other
+            # channels that are being imported)
+            messages = await asyncio.get_running_loop().run_in_executor(
+                parse_pool,
+                list,
+                slack_channel_messages(self._export, chan_name, self._users, emoji_replace, pins)
+            )
 
-        for chan_name, init_topic, pins, is_private in slack_channels(self._data_dir):
-            if self._channels is not None and chan_name.lower() not in self._channels:
-                __log__.info("Skipping channel '#%s' - not in the list of channels to import", chan_name)
-                continue
+            messages = list(self._messages_in_range(messages))
+            streams = FilePrefetcher(
+                [m for msg in messages for m in (msg, *msg.replies)],
+                functools.partial(open_stream, pool=self._http_pool, executor=self._http_executor),
+            )
+            try:
+                for msg in messages:
+                    # Now that we have a message to send, get/create the channel to send it to
+                    if ch is None:
+                        if prev_ready is not None:
+                            await prev_ready.wait()
+
+                        if chan_name not in self._existing_channels:
+                            if self._all_private or is_private:
+                                __log__.info("Creating '#%s' as a private channel", chan_name)
+                                overwrites = {
+                                    g.default_role: discord.PermissionOverwrite(read_messages=False),
+                                    g.me: discord.PermissionOverwrite(read_messages=True),
+                                }
+                                ch = await g.create_text_channel(chan_name, topic=init_topic, overwrites=overwrites)
+                            else:
+                                __log__.info("Creating '#%s' as a public channel", chan_name)
+                                ch = await g.create_text_channel(chan_name, topic=init_topic)
+                        else:
+                            ch = self._existing_channels[chan_name]
+                        ready.set()
+
+                        ch_webhook = await ch.create_webhook(
+                            name="s2d-importer",
+                            reason="For importing messages into '#{}'".format(chan_name)
+                        )
+                        ch_send = rate_limited(functools.partial(ch_webhook.send, wait=True))
+
+                    topic = msg.events.get("topic", None)
+                    if topic is not None and topic != ch.topic:
+                        # Note that the ratelimit is pretty extreme for this
+                        # (2 edits per 10 minutes) so it may take a while if there
+                        # a lot of topic changes
+                        await ch.edit(topic=topic)
+
+                    # Send message and threaded replies
+                    await self._handle_date_sep(ch, msg, prev_msg)
+                    prev_msg = msg
+                    sent = await self._send_slack_msg(ch_send, msg, streams)
+                    c_msg += 1
+                    if sent and msg.replies:
+                        await self._send_thread(ch_webhook, sent, msg, streams)
+                        c_msg += len(msg.replies)
+            finally:
+                streams.close()
+        finally:
+            ready.set()
+            if ch_webhook:
+                await ch_webhook.delete()
 
-            ch = None
-            ch_webhook, ch_send = None, None
-            c_msg_start = c_msg
+        __log__.info("Imported %s messages into '#%s'", c_msg, chan_name)
+        return ch is not None, c_msg
 
-            self._prev_msg = None  # always start with the date in a new channel
+    async def _run_import(self, g):
+        emoji_replace = EmojiReplacer({x.name: str(x) for x in self.emojis})
 
-            init_topic = emoji_replace(init_topic, emoji_map)
+        __log__.info("Starting to import messages")
+        start_time = datetime.now()
 
-            __log__.info("Processing channel '#%s'...", chan_name)
+        self._existing_channels = {x.name: x for x in g.text_channels}
+        self._filesize_limit = g.filesize_limit
 
-            for msg in slack_channel_messages(self._data_dir, chan_name, self._users, emoji_map, pins):
-                # skip messages that are too early, stop when messages are too late
-                if self._end and msg["datetime"].date() > self._end:
-                    break
-                elif self._start and  msg["datetime"].date() < self._start:
-                    continue
+        for webhook in await g.webhooks():
+            if webhook.user == self.user and webhook.name == "s2d-importer":
+                __log__.info("Cleaning up previous webhook %s", webhook)
+                await webhook.delete()
 
-                # Now that we have a message to send, get/create the channel to send it to
-                if ch is None:
-                    if chan_name not in existing_channels:
-                        if self._all_private or is_private:
-                            __log__.info("Creating '#%s' as a private channel", chan_name)
-                            overwrites = {
-                                g.default_role: discord.PermissionOverwrite(read_messages=False),
-                                g.me: discord.PermissionOverwrite(read_messages=True),
-                            }
-                            ch = await g.create_text_channel(chan_name, topic=init_topic, overwrites=overwrites)
-                        else:
-                            __log__.info("Creating '#%s' as a public channel", chan_name)
-                            ch = await g.create_text_channel(chan_name, topic=init_topic)
-                    else:
-                        ch = existing_channels[chan_name]
-                    c_chan += 1
-
-                    ch_webhook = await ch.create_webhook(
-                        name="s2d-importer",
-                        reason="For importing messages into '#{}'".format(chan_name)
+        channels = []
+        for chan in slack_channels(self._export):
+            if self._channels is not None and chan[0].lower() not in self._channels:
+                __log__.info("Skipping channel '#%s' - not in the list of channels to import", chan[0])
+            else:
+                channels.append(chan)
+
+        # Import up to CONCURRENT_CHANNELS channels at once. Each worker takes the next channel
+        # from the shared iterator when it finishes its current one.
+        results = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as parse_pool:
+            def _channel_args():
+                prev_ready = None
+                for chan in channels:
+                    ready = asyncio.Event()
+                    yield chan, prev_ready, ready
+                    prev_ready = ready
+
+            channel_args = _channel_args()
+
+            async def worker():
+                for chan, prev_ready, ready in channel_args:
+                    results.append(
+                        await self._import_channel(g, chan, emoji_replace, parse_pool, prev_ready, ready)
                     )
-                    ch_send = functools.partial(ch_webhook.send, wait=True)
-
-                topic = msg["events"].get("topic", None)
-                if topic is not None and topic != ch.topic:
-                    # Note that the ratelimit is pretty extreme for this
-                    # (2 edits per 10 minutes) so it may take a while if there
-                    # a lot of topic changes
-                    await ch.edit(topic=topic)
-
-                # Send message and threaded replies
-                await self._handle_date_sep(ch, msg)
-                sent = await self._send_slack_msg(ch_send, msg)
-                c_msg += 1
-                if sent and msg["replies"]:
-                    thread_name = (
-                        textwrap.wrap(msg.get("text") or "", max_lines=1, width=MAX_THREADNAME_SIZE, placeholder="…") or
-                        [BACKUP_THREAD_NAME.format(**msg).replace(":", "-")]  # ':' is not allowed in thread names
-                    )[0]
-                    thread = await sent.create_thread(name=thread_name)
-                    try:
-                        thread_send = functools.partial(ch_send, thread=thread)
-                        for rmsg in msg["replies"]:
-                            await self._handle_date_sep(thread, rmsg)
-                            await self._send_slack_msg(thread_send, rmsg)
-                            c_msg += 1
-                    finally:
-                        await thread.edit(archived=True)
-
-                    # calculate next date separator based on the last message sent to the main channel
-                    self._prev_msg = msg
 
-            if ch_webhook:
-                await ch_webhook.delete()
+            workers = [asyncio.ensure_future(worker()) for _ in range(CONCURRENT_CHANNELS)]
+            try:
+                await asyncio.gather(*workers)
+            finally:
+                for w in workers:
+                    w.cancel()
 
-            __log__.info("Imported %s messages into '#%s'", c_msg - c_msg_start, chan_name)
         __log__.info(
             "Finished importing %d messages into %d channel(s) in %s",
-            c_msg,
-            c_chan,
+            sum(x[1] for x in results),
+            sum(x[0] for x in results),
             datetime.now()-start_time
         )
 
 
 def run_import(*, zipfile, token, **kwargs):
-    __log__.info("Extracting Slack export zip")
-    with tempfile.TemporaryDirectory() as t:
-        with ZipFile(zipfile, "r") as z:
-            # Non-ASCII filenames in the zip seem to be encoded using UTF-8, but don't set the flag
-            # that signals this. This means Python will use cp437 to decode them, resulting in
-            # mangled filenames. Fix this by undoing the cp437 decode and using UTF-8 instead
-            for zipinfo in z.infolist():
-                if not zipinfo.flag_bits & (1 << 11):
-                    # UTF-8 flag not set, cp437 was used to decode the filename
-                    with contextlib.suppress(UnicodeEncodeError, UnicodeDecodeError):
-                        zipinfo.filename = zipinfo.filename.encode("cp437").decode("utf-8")
-                z.extract(zipinfo, path=t)
-
+    __log__.info("Opening Slack export zip")
+    with SlackExport(zipfile) as export:
         __log__.info("Logging the bot into Discord")
-        client = SlackImportClient(data_dir=t, **kwargs)
+        client = SlackImportClient(export=export, **kwargs)
         client.run(token, reconnect=False, log_handler=None)
         if client._exception:
             raise client._exception
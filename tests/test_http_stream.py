@@ -4,69 +4,114 @@ import functools
 from http import HTTPStatus
 import http.server
 import io
+import re
 import threading
 
 import pytest
+import urllib3
 
 from slack_to_discord.http_stream import SeekableHTTPStream, CachedSeekableHTTPStream
 
 
 RESP_SIZE = 100
+RESP_DATA = bytes(range(RESP_SIZE))
+RESP_VIEW = memoryview(RESP_DATA)  # for writing slices without copying
 
+# scratch space for readinto tests
+READ_BUFFER = bytearray(64)
 
-# TODO: make tests for non-seekable and/or unknown length responses
+# plain ints so the handler doesn't go through the enum for every response
+STATUS_OK = int(HTTPStatus.OK)
+STATUS_PARTIAL_CONTENT = int(HTTPStatus.PARTIAL_CONTENT)
+STATUS_RANGE_NOT_SATISFIABLE = int(HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+
+RANGE_RE = re.compile(r"bytes=(\d*)-(\d*)")
+# every offset into the response, for parsing Range values without int()
+# (anything not in here is treated as out of range)
+RANGE_OFFSETS = {str(i): i for i in range(RESP_SIZE + 1)}
 
-def gen_bytes(s, e):
-    return b"".join(bytes([x]) for x in range(s, e))
 
+# TODO: make tests for non-seekable and/or unknown length responses
 
 class HTTPRangeRequestHandler(http.server.SimpleHTTPRequestHandler):
+    # keep connections open between requests
+    protocol_version = "HTTP/1.1"
+
+    # buffer writes so the headers and body of a response are sent together
+    wbufsize = -1
+
+    # total number of requests served (to check how many requests streams make)
+    num_requests = 0
+
+    def log_message(self, *args):
+        # don't spam stderr with every request
+        pass
+
     def do_GET(self):
+        HTTPRangeRequestHandler.num_requests += 1
         range_ = self.headers.get("Range")
         start, end = 0, RESP_SIZE
         if range_ is not None:
-            _, r = range_.split("bytes=", 1)
-            s, e = r.split("-", 1)
-            if e:
-                end = int(e)
-            if s:
-                start = int(s)
-
-            if not 0 <= start < end <= RESP_SIZE:
-                self.send_response(HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+            m = RANGE_RE.fullmatch(range_)
+            if m:
+                s, e = m.groups()
+                if e:
+                    end = RANGE_OFFSETS.get(e, RESP_SIZE) + 1  # range ends are inclusive
+                if s:
+                    start = RANGE_OFFSETS.get(s, RESP_SIZE)
+
+            if not m or not 0 <= start < end <= RESP_SIZE:
+                self.send_response(STATUS_RANGE_NOT_SATISFIABLE)
+                self.send_header("Content-Length", 0)
                 self.end_headers()
                 return
             else:
-                self.send_response(HTTPStatus.PARTIAL_CONTENT)
-                self.send_header("Content-Range", f"bytes {start}-{end-1}/{RESP_SIZE}")
+                self.send_response(STATUS_PARTIAL_CONTENT)
+                self.send_header("Content-Range", "bytes %d-%d/%d" % (start, end - 1, RESP_SIZE))
         else:
-            self.send_response(HTTPStatus.OK)
+            self.send_response(STATUS_OK)
 
         self.send_header("Accept-Ranges", "bytes")
-        self.send_header("Content-Length", end - start)
+        if range_ is not None or self.path != "/nolength":
+            self.send_header("Content-Length", end - start)
+        else:
+            # the end of the data is signalled by closing the connection
+            self.send_header("Connection", "close")
         self.end_headers()
-        self.wfile.write(gen_bytes(start, end))
+        self.wfile.write(RESP_VIEW[start:end])
 
 
-@pytest.fixture(scope="module")
+@pytest.fixture(scope="session")
 def mockserver():
-    s = http.server.HTTPServer(("127.0.0.1", 0), HTTPRangeRequestHandler)
-    thread = threading.Thread(target=s.serve_forever)
+    s = http.server.ThreadingHTTPServer(("127.0.0.1", 0), HTTPRangeRequestHandler)
+    s.daemon_threads = True
+    # a short poll interval makes shutdown() return quickly (it waits for the next poll)
+    thread = threading.Thread(target=s.serve_forever, kwargs={"poll_interval": 0.01}, daemon=True)
     thread.start()
     try:
         yield f"http://127.0.0.1:{s.server_port}"
     finally:
         s.shutdown()
-        thread.join()
+        s.server_close()
+
+
+@pytest.fixture(scope="session")
+def http_pool():
+    # shared between tests so connections to the mock server are reused
+    pool = urllib3.PoolManager()
+    try:
+        yield pool
+    finally:
+        pool.clear()
 
 
 @pytest.mark.parametrize("stream_cls", [
     SeekableHTTPStream,
     CachedSeekableHTTPStream,
     functools.partial(CachedSeekableHTTPStream, max_buffer_size=50, force_cache=True)
-])
-def test_http_stream(mockserver, stream_cls):
-    s = stream_cls(mockserver, chunk_size=10)
+], ids=["seekable", "cached", "cached_force"])
+def test_http_stream(mockserver, http_pool, stream_cls):
+    s = stream_cls(mockserver, chunk_size=10, pool=http_pool)
 
     assert s.readable()
     assert s.seekable()
@@ -74,58 +119,128 @@ def test_http_stream(mockserver, stream_cls):
 
     assert len(s) == RESP_SIZE
 
-    # test reading chunks
-    assert s.read(10) == gen_bytes(0, 10)
-    assert s.read(10) == gen_bytes(10, 20)
-    assert s.read(10) == gen_bytes(20, 30)
+    # test peek/read1 before anything has been read (and cached)
+    # peek doesn't move the position, read1 gets the data that's available
+    assert s.peek(5)[:5] == RESP_DATA[:5]
+    assert s.tell() == 0
+    assert s.read1(5) == RESP_DATA[:5]
+    assert s.tell() == 5
+    assert s.seek(0) == 0
 
-    # test seeking
-    assert s.seek(10, io.SEEK_CUR) == 40
-    assert s.seek(-10, io.SEEK_CUR) == 30
-    assert s.seek(0, io.SEEK_END) == RESP_SIZE
-    assert s.seek(-10, io.SEEK_END) == RESP_SIZE - 10
-    assert s.seek(5, io.SEEK_SET) == 5
+    # (method, args, expected result) - run in order and compared all at once
+    ops = [
+        # test reading chunks
+        ("read", (10,), RESP_DATA[:10]),
+        ("read", (10,), RESP_DATA[10:20]),
+        ("read", (10,), RESP_DATA[20:30]),
+
+        # test seeking
+        ("seek", (10, io.SEEK_CUR), 40),
+        ("seek", (-10, io.SEEK_CUR), 30),
+        ("seek", (0, io.SEEK_END), RESP_SIZE),
+        ("seek", (-10, io.SEEK_END), RESP_SIZE - 10),
+        ("seek", (5, io.SEEK_SET), 5),
+
+        # test reading across chunks
+        ("read", (10,), RESP_DATA[5:15]),
+        ("tell", (), 15),
+
+        # test seeking back from current pos and getting data we just got just reads
+        # it from the buffer
+        ("seek", (-10, io.SEEK_CUR), 5),
+        ("read", (10,), RESP_DATA[5:15]),
+
+        # test seeking past the end stops at the end and returns no data
+        ("seek", (RESP_SIZE * 2,), RESP_SIZE),
+        ("read", (), b""),
+
+        # test read with no args gets everything
+        ("seek", (50,), 50),
+        ("read", (), RESP_DATA[50:]),
+    ]
+    results = [getattr(s, name)(*args) for name, args, _ in ops]
+    assert results == [expected for _, _, expected in ops]
 
-    # test reading across chunks
-    assert s.read(10) == gen_bytes(5, 15)
-    assert s.tell() == 15
+    # test readinto
+    b = memoryview(READ_BUFFER)[:20]
+    assert s.seek(5) == 5
+    assert s.readinto(b) == 20
+    assert s.tell() == 25
+    assert b == RESP_DATA[5:25]
+
+    # test peek doesn't move the position
+    assert s.peek(5)[:5] == RESP_DATA[25:30]
+    assert s.tell() == 25
+
+    # test read1/readinto1 (data is available so they should get all of it)
+    assert s.read1(5) == RESP_DATA[25:30]
+    assert s.readinto1(b) == 20
+    assert s.tell() == 50
+    assert b == RESP_DATA[30:50]
+
+
+def test_http_stream_sequential_reads_single_request(mockserver, http_pool):
+    num_requests = HTTPRangeRequestHandler.num_requests
+    s = SeekableHTTPStream(mockserver, chunk_size=10, pool=http_pool)
+
+    # small reads are served from the buffer and the rest of the open response
+    for i in range(0, 50, 5):
+        assert s.read(5) == RESP_DATA[i:i+5]
+
+    # so are short seeks forwards
+    assert s.seek(15, io.SEEK_CUR) == 65
+    assert s.read() == RESP_DATA[65:]
+
+    assert HTTPRangeRequestHandler.num_requests - num_requests == 1
 
-    # test seeking back from current pos and getting data we just got just reads
-    # it from the buffer
-    assert s.seek(-10, io.SEEK_CUR) == 5
-    assert s.read(10) == gen_bytes(5, 15)
 
-    # test seeking past the end stops at the end and returns no data
-    assert s.seek(RESP_SIZE * 2) == RESP_SIZE
-    assert s.read() == b""
+def test_http_stream_length_from_content_range(mockserver, http_pool):
+    s = SeekableHTTPStream(f"{mockserver}/nolength", chunk_size=10, pool=http_pool)
+    with pytest.raises(TypeError):
+        len(s)
 
-    # test read with no args gets everything
+    # the range request made to seek gets the length from the Content-Range header
     assert s.seek(50) == 50
-    assert s.read() == gen_bytes(50, 100)
+    assert len(s) == RESP_SIZE
+    assert s.seek(-10, io.SEEK_END) == RESP_SIZE - 10
+    assert s.read() == RESP_DATA[90:]
 
-    # test readinto
-    b = bytearray(20)
+
+def test_cached_http_stream_readinto(mockserver, http_pool):
+    s = CachedSeekableHTTPStream(mockserver, chunk_size=10, pool=http_pool, force_cache=True)
+    b = memoryview(READ_BUFFER)[:20]
+
+    # nothing is cached yet - read from the stream straight into the buffer
+    assert s.readinto(b[:10]) == 10
+    assert b[:10] == RESP_DATA[:10]
+
+    # read that's partially cached and partially from the stream
     assert s.seek(5) == 5
     assert s.readinto(b) == 20
+    assert b == RESP_DATA[5:25]
     assert s.tell() == 25
-    assert bytes(b) == gen_bytes(5, 25)
+
+    # everything read from the stream was cached
+    assert s._cache_size == 25
+    assert s.seek(0) == 0
+    assert s._cache.read() == RESP_DATA[:25]
 
 
-def test_cached_http_stream_read_rolls(mockserver):
-    s = CachedSeekableHTTPStream(mockserver, chunk_size=10, max_buffer_size=50, force_cache=True)
+def test_cached_http_stream_read_rolls(mockserver, http_pool):
+    s = CachedSeekableHTTPStream(mockserver, chunk_size=10, pool=http_pool, max_buffer_size=50, force_cache=True)
     assert s._cache
 
-    assert s.read(50) == gen_bytes(0, 50)
+    assert s.read(50) == RESP_DATA[:50]
     assert not s._cache._rolled
 
-    assert s.read(1) == gen_bytes(50, 51)
+    assert s.read(1) == RESP_DATA[50:51]
     assert s._cache._rolled
 
     assert s.seek(0) == 0
-    assert s.read() == gen_bytes(0, 100)
+    assert s.read() == RESP_DATA
 
-def test_cached_http_stream_seek_rolls(mockserver):
-    s = CachedSeekableHTTPStream(mockserver, chunk_size=10, max_buffer_size=50, force_cache=True)
+def test_cached_http_stream_seek_rolls(mockserver, http_pool):
+    s = CachedSeekableHTTPStream(mockserver, chunk_size=10, pool=http_pool, max_buffer_size=50, force_cache=True)
     assert s._cache
 
     assert not s._cache._rolled
@@ -134,4 +249,4 @@ def test_cached_http_stream_seek_rolls(mockserver):
     assert s.read(1) == b""
 
     assert s.seek(0) == 0
-    assert s.read() == gen_bytes(0, 100)
+    assert s.read() == RESP_DATA
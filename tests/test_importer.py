@@ -0,0 +1,344 @@
+#!/usr/bin/env python
+
+import asyncio
+import functools
+import html
+import io
+import json
+import zipfile
+from datetime import time
+from types import SimpleNamespace
+
+import pytest
+
+from slack_to_discord.importer import (
+    MARKUP_RE, EmojiReplacer, FilePrefetcher, SlackExport, format_time, make_userinfo,
+    markup_repl, slack_channel_messages, slack_unescape
+)
+
+
+USERS = {"U1": make_userinfo("some_user")}
+EMOJI_REPLACE = EmojiReplacer({"custom": "<:custom:123>"})
+
+
+def markup(text):
+    return MARKUP_RE.sub(functools.partial(markup_repl, USERS.get, EMOJI_REPLACE), text)
+
+
+def make_zip(files):
+    # Build a zip in memory from {path: data} (non-bytes data is JSON-encoded)
+    buff = io.BytesIO()
+    with zipfile.ZipFile(buff, "w") as zf:
+        for path, data in files.items():
+            if not isinstance(data, bytes):
+                data = json.dumps(data)
+            zf.writestr(path, data)
+    return buff.getvalue()
+
+
+def make_export(files):
+    return SlackExport(io.BytesIO(make_zip(files)))
+
+
+def channel_messages(days):
+    # Parse the channel's day files and return [(text, [reply text, ...]), ...]
+    export = make_export({"general/{}.json".format(k): v for k, v in days.items()})
+    msgs = slack_channel_messages(export, "general", dict(USERS), EMOJI_REPLACE, set())
+    return [(m.text, [r.text for r in m.replies]) for m in msgs]
+
+
+@pytest.mark.parametrize("text", [
+    "",
+    "no entities",
+    "&lt;b&gt;bold&lt;/b&gt;",
+    "this &amp; that",
+    # "&amp;" must be replaced last so this doesn't become "<"
+    "&amp;lt;",
+    "&amp;amp;",
+    "&lt;&gt;&amp;&amp;amp;",
+    # anything else falls back to html.unescape
+    "AT&T",
+    "&quot;quoted&quot; &lt;",
+    "&copy 2020",
+    "&#x1F600; &amp;",
+    "trailing &",
+])
+def test_slack_unescape(text):
+    assert slack_unescape(text) == html.unescape(text)
+
+
+@pytest.mark.parametrize("fmt, expected", [
+    ("%H:%M", "10:11"),
+    ("%H:%M:%S", "10:11:42"),
+])
+def test_format_time(monkeypatch, fmt, expected):
+    monkeypatch.setattr("slack_to_discord.importer.TIME_FORMAT", fmt)
+    format_time.cache_clear()
+    try:
+        assert format_time(time(10, 11, 42)) == expected
+    finally:
+        format_time.cache_clear()
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("plain text", "plain text"),
+    # mentions
+    ("hi <@U1>", "hi `@some_user`"),
+    ("<@U2>", "`@[unknown]`"),
+    ("<!here>", "`@here`"),
+    ("<#C1|general>", "`#general`"),
+    ("<@U1|name>", "<@U1|name>"),
+    # links
+    ("<https://example.com/a?b=1|link>", "https://example.com/a?b=1"),
+    ("<https://example.com>", "<https://example.com>"),
+    ("<tel:+15555555555|call>", "tel:+15555555555"),
+    # emojis
+    (":custom:", "<:custom:123>"),
+    (":custom::skin-tone-2:", "<:custom:123>"),
+    (":not_an_emoji:", ":not_an_emoji:"),
+    ("12:30:45", "12:30:45"),
+    # emojis directly after mentions/links are still replaced (the colons in the
+    # mention/link are consumed by it and can't pair up with the emoji's)
+    ("<mailto:a@example.com|a@example.com>:custom:", "mailto:a@example.com<:custom:123>"),
+    ("<https://example.com:8080/|x>:custom:", "https://example.com:8080/<:custom:123>"),
+    ("<@U1>:custom:", "`@some_user`<:custom:123>"),
+])
+def test_markup(text, expected):
+    assert markup(text) == expected
+
+
+def test_export_utf8_filenames():
+    # Exports store UTF-8 filenames without setting the flag that says so. Simulate that by
+    # writing an ASCII placeholder (no flag) and swapping in the UTF-8 bytes afterwards.
+    data = make_zip({"cafXX/2020-01-01.json": [], "ok/2020-01-01.json": []})
+    data = data.replace(b"cafXX", "café".encode("utf-8"))
+    with SlackExport(io.BytesIO(data)) as export:
+        assert export.channel_files("café") == ["café/2020-01-01.json"]
+        assert export.open_json("café/2020-01-01.json") == []
+        assert export.channel_files("ok") == ["ok/2020-01-01.json"]
+
+    # Filenames with the flag set are left alone
+    with make_export({"ünï/2020-01-01.json": []}) as export:
+        assert export.channel_files("ünï") == ["ünï/2020-01-01.json"]
+
+
+def test_export_channel_files():
+    with make_export({
+        "users.json": [],
+        "2020-01-01.json": [],
+        "general/": b"",
+        "general/2020-01-02.json": [],
+        "general/notes.json": [],
+        "general/2020-01-01.json": [],
+        "general/2019-12-31.json": [],
+        "2020-01-03/": b"",
+        "random/2020-01-01.json": [],
+    }) as export:
+        assert export.channel_files("general") == [
+            "general/2019-12-31.json", "general/2020-01-01.json", "general/2020-01-02.json"
+        ]
+        assert export.channel_files("random") == ["random/2020-01-01.json"]
+        assert export.channel_files("2020-01-03") == []
+        assert export.channel_files("missing") == []
+
+
+def test_export_open_json():
+    with make_export({
+        "users.json": [{"id": "U1"}],
+        # orjson rejects lone surrogates, the stdlib doesn't
+        "channels.json": b'[{"name": "\\ud800"}]',
+    }) as export:
+        assert export.open_json("users.json") == [{"id": "U1"}]
+        assert export.open_json("channels.json") == [{"name": "\ud800"}]
+        with pytest.raises(FileNotFoundError):
+            export.open_json("groups.json")
+
+
+PARENT = {"ts": "1.0", "user": "U1", "text": "parent"}
+
+
+def reply(ts, text):
+    return {"ts": ts, "thread_ts": "1.0", "user": "U1", "text": text}
+
+
+@pytest.mark.parametrize("days, expected", [
+    # duplicated replies keep their original spot with the latest text
+    (
+        {"2020-01-01": [PARENT, reply("2.0", "a"), reply("3.0", "b")], "2020-01-02": [reply("2.0", "a2")]},
+        [("parent", ["a2", "b"])],
+    ),
+    # a duplicated parent starts its replies over
+    (
+        {"2020-01-01": [PARENT, reply("2.0", "reply")], "2020-01-02": [PARENT, reply("2.0", "reply")]},
+        [("parent", ["reply"])],
+    ),
+    (
+        {"2020-01-01": [PARENT, reply("2.0", "a")], "2020-01-02": [PARENT, reply("3.0", "b"), reply("2.0", "a2")]},
+        [("parent", ["a2", "b"])],
+    ),
+    # the same reply ts in different threads isn't a duplicate
+    (
+        {"2020-01-01": [PARENT, {"ts": "1.5", "user": "U1", "text": "other"},
+                        reply("2.0", "a"), dict(reply("2.0", "b"), thread_ts="1.5")]},
+        [("parent", ["a"]), ("other", ["b"])],
+    ),
+    # orphaned replies are dropped
+    ({"2020-01-01": [reply("2.0", "orphan")]}, []),
+])
+def test_channel_message_duplicates(days, expected):
+    assert channel_messages(days) == expected
+
+
+class FakeStream:
+    def __init__(self, url):
+        self.url = url
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class FakeOpener:
+    """Records the URLs that are opened, optionally blocking until released"""
+
+    def __init__(self, blocked=False):
+        self.opened = {}
+        self._release = asyncio.Event()
+        if not blocked:
+            self._release.set()
+
+    def release(self):
+        self._release.set()
+
+    async def __call__(self, url):
+        assert url not in self.opened
+        stream = self.opened[url] = FakeStream(url)
+        await self._release.wait()
+        return stream
+
+
+def make_msgs(*files):
+    # One message per string of single-character file URLs ("ab" -> files "a" and "b")
+    return [SimpleNamespace(files=[{"url": u} for u in f]) for f in files]
+
+
+async def settle():
+    # Let the open tasks run
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def run(coro_func):
+    return asyncio.run(coro_func())
+
+
+def test_file_prefetcher_limits():
+    async def test():
+        msgs = make_msgs("abc", "d", "e", "f")
+        opener = FakeOpener()
+        streams = FilePrefetcher(msgs, opener, max_open=2, max_ahead=2)
+
+        # more files than max_open on a message are opened as earlier ones are used
+        streams.sending(msgs[0])
+        await settle()
+        assert list(opener.opened) == ["a", "b"]
+        assert (await streams.pop("a")).url == "a"
+        await settle()
+        assert list(opener.opened) == ["a", "b", "c"]
+
+        # files for later messages are opened up to max_ahead messages ahead
+        await streams.pop("b")
+        await streams.pop("c")
+        await settle()
+        assert list(opener.opened) == ["a", "b", "c", "d", "e"]
+
+        streams.sending(msgs[1])
+        await streams.pop("d")
+        await settle()
+        assert list(opener.opened) == ["a", "b", "c", "d", "e", "f"]
+        streams.close()
+
+    run(test)
+
+
+def test_file_prefetcher_max_ahead():
+    async def test():
+        msgs = make_msgs("a", "b", "c", "d")
+        opener = FakeOpener()
+        streams = FilePrefetcher(msgs, opener, max_open=5, max_ahead=1)
+
+        streams.sending(msgs[0])
+        await settle()
+        assert list(opener.opened) == ["a", "b"]
+
+        streams.sending(msgs[1])
+        await settle()
+        assert list(opener.opened) == ["a", "b", "c"]
+        streams.close()
+
+    run(test)
+
+
+def test_file_prefetcher_skip_messages():
+    async def test():
+        msgs = make_msgs("ab", "c", "d", "ef")
+        opener = FakeOpener()
+        streams = FilePrefetcher(msgs, opener, max_open=2, max_ahead=1)
+
+        streams.sending(msgs[0])
+        await settle()
+        assert list(opener.opened) == ["a", "b"]
+
+        # jumping ahead closes the streams for the skipped messages and never opens the rest
+        streams.sending(msgs[3])
+        await settle()
+        assert list(opener.opened) == ["a", "b", "e", "f"]
+        assert opener.opened["a"].closed and opener.opened["b"].closed
+        assert not opener.opened["e"].closed and not opener.opened["f"].closed
+        assert streams.pop("c") is None
+        streams.close()
+
+    run(test)
+
+
+def test_file_prefetcher_pop_unopened():
+    async def test():
+        msgs = make_msgs("ab", "c")
+        opener = FakeOpener()
+        streams = FilePrefetcher(msgs, opener, max_open=1, max_ahead=1)
+
+        streams.sending(msgs[0])
+        await settle()
+        assert list(opener.opened) == ["a"]
+
+        # URLs that weren't opened ahead of time (ex: thumbnails) return the default
+        assert streams.pop("a-thumb", "default") == "default"
+
+        # the current message's next file is taken by the caller so it's never opened
+        assert streams.pop("b") is None
+        await streams.pop("a")
+        await settle()
+        assert list(opener.opened) == ["a", "c"]
+        streams.close()
+
+    run(test)
+
+
+def test_file_prefetcher_close_pending():
+    async def test():
+        msgs = make_msgs("ab")
+        opener = FakeOpener(blocked=True)
+        streams = FilePrefetcher(msgs, opener)
+
+        streams.sending(msgs[0])
+        await settle()
+        streams.close()
+        assert not any(s.closed for s in opener.opened.values())
+
+        # streams are closed as soon as they finish opening
+        opener.release()
+        await settle()
+        assert list(opener.opened) == ["a", "b"]
+        assert all(s.closed for s in opener.opened.values())
+
+    run(test)